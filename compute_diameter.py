@@ -18,25 +18,44 @@
 from __future__ import annotations
 
 import argparse
-import csv
-import math
+import collections
+import contextlib
+import functools
+import mmap
+import os
 import re
+import struct
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Optional, Tuple, Dict
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Dict
 
+import numpy as np
 from PIL import Image
 
 
 IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"]
 
+# CSV 输出的写缓冲大小（1 MiB）
+CSV_BUFFER_SIZE = 1 << 20
+
+# 与 csv.writer 的 QUOTE_MINIMAL 一致：仅含这些字符的字段需要加引号
+_CSV_NEEDS_QUOTE = re.compile(r'[,"\r\n]')
+
+# 串行处理（--workers 1）时的标签文件预读：后台线程提前把后面 PREFETCH_DEPTH 个文件读入系统页缓存
+PREFETCH_THREADS = 8
+PREFETCH_DEPTH = 32
+
 
 def find_label_files(path: Path) -> Iterable[Path]:
     if path.is_file():
         yield path
         return
-    for p in path.rglob("*.txt"):
-        yield p
+    # os.walk 基于 scandir，只为命中的 .txt 构造 Path；normcase 使 Windows 下扩展名不区分大小写（与 rglob 一致）
+    for root, _, names in os.walk(path):
+        for name in names:
+            if os.path.normcase(name).endswith(".txt"):
+                yield Path(root, name)
 
 
 def load_classes(classes_path: Optional[Path]) -> Dict[int, str]:
@@ -58,19 +77,84 @@ def load_classes(classes_path: Optional[Path]) -> Dict[int, str]:
     return names
 
 
+@functools.lru_cache(maxsize=None)
+def _dir_index(d: Path) -> Dict[str, Path]:
+    """扫描一次目录，返回 {normcase(文件名主干): 图片路径}；同名多种扩展名时按 IMAGE_EXTS 顺序优先。
+
+    键经过 os.path.normcase，在 Windows 上与 Path.exists() 一样不区分大小写。
+    """
+    rank = {ext: i for i, ext in enumerate(IMAGE_EXTS)}
+    best: Dict[str, Tuple[int, Path]] = {}
+    try:
+        entries = os.scandir(d)
+    except OSError:
+        return {}
+    with entries:
+        for e in entries:
+            stem, ext = os.path.splitext(e.name)
+            stem = os.path.normcase(stem)
+            r = rank.get(ext.lower())
+            if r is None or (stem in best and best[stem][0] <= r) or not e.is_file():
+                continue
+            best[stem] = (r, Path(e.path))
+    return {stem: p for stem, (_, p) in best.items()}
+
+
 def find_image_for_label(label_path: Path) -> Optional[Path]:
-    base = label_path.with_suffix("")
+    stem = os.path.normcase(label_path.stem)
     parent = label_path.parent
-    for ext in IMAGE_EXTS:
-        cand = parent / (base.name + ext)
-        if cand.exists():
-            return cand
-    # try same stem in parent (in case label is in labels/ and images in images/)
-    for ext in IMAGE_EXTS:
-        cand = parent.parent / (base.name + ext)
-        if cand.exists():
-            return cand
-    return None
+    # try same stem in parent too (in case label is in labels/ and images in images/)
+    return _dir_index(parent).get(stem) or _dir_index(parent.parent).get(stem)
+
+
+_JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+
+def _jpeg_size(fh) -> Optional[Tuple[int, int]]:
+    # 跳过各段直到 SOFn，SOFn 段内依次为 length(2) precision(1) height(2) width(2)
+    fh.seek(2)
+    while True:
+        b = fh.read(1)
+        while b and b != b"\xff":
+            b = fh.read(1)
+        while b == b"\xff":
+            b = fh.read(1)
+        if not b:
+            return None
+        marker = b[0]
+        if marker in _JPEG_SOF_MARKERS:
+            seg = fh.read(7)
+            if len(seg) < 7:
+                return None
+            h, w = struct.unpack(">HH", seg[3:7])
+            return w, h
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # 无长度字段的标记
+            continue
+        seg = fh.read(2)
+        if len(seg) < 2:
+            return None
+        fh.seek(struct.unpack(">H", seg)[0] - 2, 1)
+
+
+@functools.lru_cache(maxsize=4096)
+def _image_size(img_path: Path) -> Tuple[int, int]:
+    with img_path.open("rb") as fh:
+        head = fh.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:2] == b"\xff\xd8":
+            size = _jpeg_size(fh)
+            if size:
+                return size
+    # 其他格式交给 PIL（Image.open 只解析文件头，不解码像素）
+    with Image.open(img_path) as im:
+        return im.size
+
+
+def image_size(img_path: Path) -> Tuple[int, int]:
+    """只读取图片文件头获得 (宽, 高)，同一路径的结果会被缓存。"""
+    return _image_size(img_path.resolve())
 
 
 def parse_line_fields(fields: List[float]) -> Tuple[str, List[float]]:
@@ -78,89 +162,190 @@ def parse_line_fields(fields: List[float]) -> Tuple[str, List[float]]:
     return ("", fields)
 
 
-def max_point_distance(pts: List[Tuple[float, float]]) -> float:
-    maxd = 0.0
-    n = len(pts)
-    for i in range(n):
-        x1, y1 = pts[i]
-        for j in range(i + 1, n):
-            x2, y2 = pts[j]
-            d = math.hypot(x2 - x1, y2 - y1)
-            if d > maxd:
-                maxd = d
-    return maxd
+# 4 个顶点的全部 6 组点对
+_QUAD_PAIRS = ((0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3))
+
+
+def _diameter_bbox(arr: np.ndarray, img_w: Optional[int], img_h: Optional[int]) -> np.ndarray:
+    """bbox 行 (class x y w h [angle]) 的像素直径 max(w, h)。
+
+    w,h ≤ 1 视为归一化坐标，用图片尺寸换算；归一化但没有图片尺寸的行返回 NaN。
+    """
+    w = arr[:, 3]
+    h = arr[:, 4]
+    normalized = (w <= 1.0) & (h <= 1.0)
+    if img_w and img_h:
+        return np.where(normalized, np.maximum(w * img_w, h * img_h), np.maximum(w, h))
+    return np.where(normalized, np.nan, np.maximum(w, h))
+
+
+def _diameter_poly(arr: np.ndarray, img_w: Optional[int], img_h: Optional[int]) -> np.ndarray:
+    """4 点多边形行 (class x1 y1 ... x4 y4) 的像素直径：顶点间最大欧氏距离。"""
+    pts = arr[:, 1:9].reshape(-1, 4, 2)
+    if img_w and img_h:
+        # 坐标全部落在 [0, 1] 的行视为归一化，换算为像素
+        normalized = ((pts >= 0.0) & (pts <= 1.0)).all(axis=(1, 2))
+        pts = np.where(normalized[:, None, None], pts * np.array([img_w, img_h], dtype=np.float64), pts)
+    d2 = np.zeros(len(pts))
+    for i, j in _QUAD_PAIRS:
+        diff = pts[:, i] - pts[:, j]
+        np.maximum(d2, np.einsum("ij,ij->i", diff, diff), out=d2)
+    return np.sqrt(d2)
+
+
+# 类别 id 需能放进 int64
+_CLASS_ID_LIMIT = 2 ** 63
+
+# 数据行：跳过行首空白后第一个字符既不是空白也不是 '#'。
+# 行首可以在 \n 之后（re.M 的 ^），也可以在单独的 \r 之后（旧式 Mac 换行）
+_DATA_LINE = re.compile(rb"(?:^|(?<=\r))[ \t]*([^#\s][^\r\n]*)", re.M)
+
+
+@contextlib.contextmanager
+def _map_label_file(path: Path):
+    """只读内存映射标签文件，在原始字节上直接解析；空文件无法映射，给出 b""。"""
+    with path.open("rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _warm_page_cache(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    except OSError:
+        return
+    try:
+        if hasattr(os, "posix_fadvise"):
+            # 交给内核异步预读，不拷贝数据
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, 1 << 20):
+                pass
+    finally:
+        os.close(fd)
+
+
+def _read_ahead(files: Iterable[Path]) -> Iterator[Path]:
+    """按原顺序产出 files，同时在线程池中预热后续文件的页缓存（读盘期间线程不占 GIL），
+    让磁盘 IO 与解析重叠。"""
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as ex:
+        window: Deque[Path] = collections.deque()
+        for f in files:
+            ex.submit(_warm_page_cache, f)
+            window.append(f)
+            if len(window) > PREFETCH_DEPTH:
+                yield window.popleft()
+        yield from window
+
+
+def _line_no(data, pos: int) -> int:
+    # \n、\r\n、单独的 \r 都算一个换行
+    head = data[:pos]
+    return head.count(b"\n") + head.count(b"\r") - head.count(b"\r\n") + 1
+
+
+def parse_label_data(label_path: Path, data) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """按字段数把数据行分组，每组一次性转换为 float64 数组。
+
+    直接在原始字节（bytes 或 mmap）上用正则跳过空行和注释行，不做解码。
+    返回 {字段数: (行起始偏移数组, 形如 (N, 字段数) 的数组)}；无法解析的行打印警告后跳过。
+    """
+    groups: Dict[int, Tuple[List[int], List[bytes]]] = {}
+    for m in _DATA_LINE.finditer(data):
+        parts = m.group(1).split()
+        offsets, tokens = groups.setdefault(len(parts), ([], []))
+        offsets.append(m.start())
+        tokens.extend(parts)
+
+    out: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+    for width, (offsets, tokens) in groups.items():
+        try:
+            arr = np.array(tokens, dtype=np.float64).reshape(-1, width)
+        except ValueError:
+            # 存在非数字字段时逐行转换，定位并跳过出错的行
+            kept, rows = [], []
+            for pos, j in zip(offsets, range(0, len(tokens), width)):
+                try:
+                    rows.append([float(x.decode("latin-1")) for x in tokens[j:j + width]])
+                except ValueError as e:
+                    print(f"warning: parse error {label_path}:{_line_no(data, pos)}: {e}", file=sys.stderr)
+                    continue
+                kept.append(pos)
+            offsets = kept
+            arr = np.array(rows, dtype=np.float64).reshape(-1, width)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        # 类别 id 为 nan/inf 或超出 int64 时无法转换为整数，按解析错误跳过
+        bad = ~(np.isfinite(arr[:, 0]) & (np.abs(arr[:, 0]) < _CLASS_ID_LIMIT))
+        if bad.any():
+            for pos in offsets[bad].tolist():
+                print(f"warning: parse error {label_path}:{_line_no(data, pos)}: invalid class id (not finite or outside int64)", file=sys.stderr)
+            offsets, arr = offsets[~bad], arr[~bad]
+        out[width] = (offsets, arr)
+    return out
 
 
 def process_label_file(label_path: Path, scale_pixels: float, scale_real: float, unit: str, classes_map: Dict[int, str]) -> List[dict]:
-    out = []
     img_path = find_image_for_label(label_path)
     if img_path:
-        with Image.open(img_path) as im:
-            img_w, img_h = im.size
+        img_w, img_h = image_size(img_path)
     else:
         img_w = img_h = None
 
-    try:
-        text = label_path.read_text(encoding="utf-8")
-    except Exception:
-        text = label_path.read_text(encoding="latin-1")
+    # 各字段数分组的结果：(行起始偏移, class_id, 像素直径) 数组
+    found: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    with _map_label_file(label_path) as data:
+        for width, (offsets, arr) in parse_label_data(label_path, data).items():
+            classes = arr[:, 0].astype(np.int64)
 
-    for i, line in enumerate(text.splitlines()):
-        s = line.strip()
-        if not s or s.startswith("#"):
-            continue
-        parts = s.split()
-        try:
-            cls = int(float(parts[0]))
-            nums = [float(x) for x in parts[1:]]
-        except Exception as e:
-            print(f"warning: parse error {label_path}:{i+1}: {e}", file=sys.stderr)
-            continue
+            if width in (5, 6):
+                diameters = _diameter_bbox(arr, img_w, img_h)
+                missing = np.isnan(diameters)
+                for pos in offsets[missing].tolist():
+                    print(f"warning: normalized bbox but image not found for {label_path}, line {_line_no(data, pos)}; skipping", file=sys.stderr)
+                keep = ~missing
+                found.append((offsets[keep], classes[keep], diameters[keep]))
 
-        diameter_px = None
-
-        if len(nums) in (4, 5):
-            # w,h at positions 2,3 (0-based after class: x,y,w,h)
-            w = nums[2]
-            h = nums[3]
-            # if normalized and image size known
-            if (w <= 1.0 and h <= 1.0) and (img_w and img_h):
-                w_px = w * img_w
-                h_px = h * img_h
-                diameter_px = max(w_px, h_px)
-            elif w > 1.0 or h > 1.0:
-                # assume already pixels
-                diameter_px = max(w, h)
-            else:
-                print(f"warning: normalized bbox but image not found for {label_path}, line {i+1}; skipping", file=sys.stderr)
-                continue
+            elif width == 9:
+                found.append((offsets, classes, _diameter_poly(arr, img_w, img_h)))
 
-        elif len(nums) == 8:
-            # polygon points normalized or absolute
-            pts = [(nums[j], nums[j + 1]) for j in range(0, 8, 2)]
-            # if normalized and have image dims, convert
-            if all(0.0 <= x <= 1.0 and 0.0 <= y <= 1.0 for x, y in pts) and (img_w and img_h):
-                pts_px = [(x * img_w, y * img_h) for x, y in pts]
             else:
-                pts_px = pts
-            diameter_px = max_point_distance(pts_px)
-
-        else:
-            print(f"warning: unsupported number of fields ({len(nums)}) in {label_path}:{i+1}; skipping", file=sys.stderr)
-            continue
-
-        real_diameter = diameter_px * (scale_real / scale_pixels)
-        out.append({
-            "image": img_path.name if img_path else "",
+                for pos in offsets.tolist():
+                    print(f"warning: unsupported number of fields ({width - 1}) in {label_path}:{_line_no(data, pos)}; skipping", file=sys.stderr)
+
+    if not found:
+        return []
+
+    # 合并各组并按行序排列，再对整列一次性换算真实直径
+    offsets, classes, diameters = (np.concatenate(col) for col in zip(*found))
+    order = np.argsort(offsets, kind="stable")
+    classes = classes[order]
+    diameters = diameters[order]
+    real_diameters = diameters * (scale_real / scale_pixels)
+
+    image = img_path.name if img_path else ""
+    return [
+        {
+            "image": image,
             "label_file": label_path.name,
             "class_id": cls,
             "class_name": classes_map.get(cls, ""),
-            "diameter_pixels": float(diameter_px),
-            "real_diameter": float(real_diameter),
+            "diameter_pixels": diameter_px,
+            "real_diameter": real_diameter,
             "unit": unit,
-        })
+        }
+        for cls, diameter_px, real_diameter in zip(classes.tolist(), diameters.tolist(), real_diameters.tolist())
+    ]
 
-    return out
+
+def _process_label_file_safe(label_path: Path, scale_pixels: float, scale_real: float, unit: str, classes_map: Dict[int, str]) -> List[dict]:
+    try:
+        return process_label_file(label_path, scale_pixels, scale_real, unit, classes_map)
+    except Exception as e:
+        print(f"error processing {label_path}: {e}", file=sys.stderr)
+        return []
 
 
 def save_csv(rows: List[dict], out_dir: Path):
@@ -186,17 +371,35 @@ def save_csv(rows: List[dict], out_dir: Path):
 
     idx = _next_index_for_prefix(out_dir, "diameters")
     out = out_dir / f"diameters_{idx:03d}.csv"
-    with out.open("w", newline="", encoding="utf-8") as fh:
-        writer = csv.writer(fh)
-        writer.writerow(["image", "label_file", "class_id", "class_name", "diameter_pixels", "real_diameter", "unit"])
-        for r in rows:
-            # round numeric outputs to 2 decimal places for better UX
-            dp = f"{r['diameter_pixels']:.2f}" if r.get('diameter_pixels') is not None else ""
-            rd = f"{r['real_diameter']:.2f}" if r.get('real_diameter') is not None else ""
-            writer.writerow([r["image"], r["label_file"], r.get("class_id", ""), r.get("class_name", ""), dp, rd, r["unit"]])
+    def _q(v) -> str:
+        v = str(v)
+        return '"' + v.replace('"', '""') + '"' if _CSV_NEEDS_QUOTE.search(v) else v
+
+    def _fmt(v) -> str:
+        # round numeric outputs to 2 decimal places for better UX
+        return f"{v:.2f}" if v is not None else ""
+
+    # 列固定且数值列无需转义，直接格式化成行，绕过 csv.writer（行尾与其默认的 \r\n 保持一致）
+    with out.open("w", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE) as fh:
+        fh.write("image,label_file,class_id,class_name,diameter_pixels,real_diameter,unit\r\n")
+        fh.writelines(
+            f"{_q(r['image'])},{_q(r['label_file'])},{r.get('class_id', '')},{_q(r.get('class_name', ''))},"
+            f"{_fmt(r.get('diameter_pixels'))},{_fmt(r.get('real_diameter'))},{_q(r['unit'])}\r\n"
+            for r in rows
+        )
     print(f"wrote: {out}")
 
 
+def _positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"需要正整数，得到 {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"需要正整数，得到 {value!r}")
+    return n
+
+
 def main():
     p = argparse.ArgumentParser(description="根据像素->真实长度比例计算标注对象的真实直径")
     p.add_argument("input", type=Path, help="标签文件或包含标签文件的文件夹")
@@ -205,6 +408,7 @@ def main():
     p.add_argument("--unit", type=str, default="um", help="真实长度单位，默认 'um'（微米）")
     p.add_argument("--out", type=Path, default=Path("diameter-result"), help="输出目录, 默认 diameter-result")
     p.add_argument("--classes", type=Path, default=None, help="可选：classes.txt 文件路径（每行一个类别名，行号即 class id）")
+    p.add_argument("--workers", type=_positive_int, default=None, help="并行进程数，默认使用全部 CPU；1 表示不并行")
     args = p.parse_args()
 
     files = list(find_label_files(args.input))
@@ -228,13 +432,14 @@ def main():
 
     classes_map = load_classes(classes_path)
 
-    all_rows = []
-    for f in files:
-        try:
-            rows = process_label_file(f, args.scale_pixels, args.scale_real, args.unit, classes_map)
-            all_rows.extend(rows)
-        except Exception as e:
-            print(f"error processing {f}: {e}", file=sys.stderr)
+    worker = functools.partial(_process_label_file_safe, scale_pixels=args.scale_pixels, scale_real=args.scale_real, unit=args.unit, classes_map=classes_map)
+    if args.workers == 1:
+        results = map(worker, _read_ahead(files))
+    else:
+        # 进程池的 map 会一次取完全部输入，预读窗口在这里不起作用，多个进程本身已让 IO 与解析重叠
+        with ProcessPoolExecutor(max_workers=args.workers) as ex:
+            results = list(ex.map(worker, files, chunksize=64))
+    all_rows = [r for rows in results for r in rows]
 
     save_csv(all_rows, args.out)
 
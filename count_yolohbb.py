@@ -8,29 +8,63 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import contextlib
 import csv
+import functools
+import itertools
+import mmap
+import os
 import re
 import sys
-from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, Tuple, Dict, Optional
+from typing import Deque, Iterable, Iterator, Tuple, Dict, Optional
+
+import numpy as np
+
+
+# CSV 输出：1 MiB 写缓冲，每批 writerows 64k 行
+CSV_BUFFER_SIZE = 1 << 20
+CSV_BATCH_ROWS = 1 << 16
+
+# np.bincount 的 id 上限（与 classes.txt 的类别数取较大者）；更大的 id 改用稀疏计数
+BINCOUNT_LIMIT = 4096
+
+# 串行处理（--workers 1）时的标签文件预读：后台线程提前把后面 PREFETCH_DEPTH 个文件读入系统页缓存
+PREFETCH_THREADS = 8
+PREFETCH_DEPTH = 32
 
 
 def find_label_files(path: Path) -> Iterable[Path]:
     if path.is_file():
         yield path
         return
-    for p in path.rglob("*.txt"):
-        yield p
+    # os.walk 基于 scandir，只为命中的 .txt 构造 Path；normcase 使 Windows 下扩展名不区分大小写（与 rglob 一致）
+    for root, _, names in os.walk(path):
+        for name in names:
+            if os.path.normcase(name).endswith(".txt"):
+                yield Path(root, name)
+
 
+# 类别 id 需能放进 int64（np.bincount 的输入）
+_CLASS_ID_LIMIT = 2 ** 63
 
-def parse_label_line(line: str) -> Tuple[int, list]:
-    parts = line.strip().split()
-    if not parts:
-        raise ValueError("empty line")
-    cls = int(float(parts[0]))
-    coords = [float(x) for x in parts[1:]]
-    return cls, coords
+
+def parse_class_id(tok: str) -> int:
+    # 类别 id 一般是整数或 "3.0" 这样的写法：直接 int() 整数部分，避免经过 float；其他写法（如 1e2）再回退
+    head, _, frac = tok.partition(".")
+    cls = None
+    if not frac or frac.isdigit():
+        try:
+            cls = int(head)
+        except ValueError:
+            pass
+    if cls is None:
+        cls = int(float(tok))
+    if not -_CLASS_ID_LIMIT <= cls < _CLASS_ID_LIMIT:
+        raise ValueError(f"class id out of range: {tok!r}")
+    return cls
 
 
 def load_classes(classes_path: Optional[Path]) -> Dict[int, str]:
@@ -52,28 +86,146 @@ def load_classes(classes_path: Optional[Path]) -> Dict[int, str]:
     return names
 
 
-def process_files(files: Iterable[Path], classes_map: Dict[int, str]) -> Tuple[dict, dict]:
-    per_file = {}
-    total = defaultdict(int)
-    for f in files:
-        counts = defaultdict(int)
+# 每个数据行的第一个字段（类别 id）；跳过空行和 '#' 注释行
+# 行首可以在 \n 之后（re.M 的 ^），也可以在单独的 \r 之后（旧式 Mac 换行）
+CLASS_TOKEN_RE = re.compile(rb"(?:^|(?<=\r))[ \t]*([^#\s]\S*)", re.M)
+
+
+@contextlib.contextmanager
+def _map_label_file(path: Path):
+    """只读内存映射标签文件，在原始字节上直接解析；空文件无法映射，给出 b""。"""
+    with path.open("rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _warm_page_cache(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    except OSError:
+        return
+    try:
+        if hasattr(os, "posix_fadvise"):
+            # 交给内核异步预读，不拷贝数据
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, 1 << 20):
+                pass
+    finally:
+        os.close(fd)
+
+
+def _read_ahead(files: Iterable[Path]) -> Iterator[Path]:
+    """按原顺序产出 files，同时在线程池中预热后续文件的页缓存（读盘期间线程不占 GIL），
+    让磁盘 IO 与解析重叠。"""
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as ex:
+        window: Deque[Path] = collections.deque()
+        for f in files:
+            ex.submit(_warm_page_cache, f)
+            window.append(f)
+            if len(window) > PREFETCH_DEPTH:
+                yield window.popleft()
+        yield from window
+
+
+def _line_no(data, pos: int) -> int:
+    # \n、\r\n、单独的 \r 都算一个换行
+    head = data[:pos]
+    return head.count(b"\n") + head.count(b"\r") - head.count(b"\r\n") + 1
+
+
+def _class_id_column(col: np.ndarray) -> np.ndarray:
+    """把类别字段列（bytes 数组）整体转换为 int64，规则同 parse_class_id。"""
+    try:
+        return col.astype(np.int64)
+    except (ValueError, OverflowError):
+        pass
+    head, _, frac = np.char.partition(col, b".").T
+    if (np.char.isdigit(frac) | (frac == b"")).all():
         try:
-            text = f.read_text(encoding="utf-8")
-        except Exception:
-            text = f.read_text(encoding="latin-1")
-        for i, line in enumerate(text.splitlines()):
-            s = line.strip()
-            if not s or s.startswith("#"):
-                continue
+            return head.astype(np.int64)
+        except (ValueError, OverflowError):
+            pass
+    values = col.astype(np.float64)
+    # nan/inf 或超出 int64 的值直接转换会得到 INT64_MIN，交给逐行路径报告
+    if not (np.isfinite(values) & (np.abs(values) < _CLASS_ID_LIMIT)).all():
+        raise ValueError("class id out of range")
+    return values.astype(np.int64)
+
+
+def parse_class_ids(label_path: Path, data) -> np.ndarray:
+    """取出每个数据行的类别 id，一次性转换为 int64 数组；无法解析的行打印警告后跳过。"""
+    # 一次正则扫描取出全部类别字段，只在需要报告行号时才再扫描一次
+    tokens = CLASS_TOKEN_RE.findall(data)
+    if not tokens:
+        return np.zeros(0, dtype=np.int64)
+    offsets = None
+    try:
+        ids = _class_id_column(np.array(tokens))
+    except ValueError:
+        offsets = [m.start() for m in CLASS_TOKEN_RE.finditer(data)]
+        kept, parsed = [], []
+        for pos, tok in zip(offsets, tokens):
             try:
-                cls, _ = parse_label_line(s)
+                parsed.append(parse_class_id(tok.decode("latin-1")))
             except Exception as e:
-                print(f"warning: failed to parse {f}:{i+1}: {e}", file=sys.stderr)
+                print(f"warning: failed to parse {label_path}:{_line_no(data, pos)}: {e}", file=sys.stderr)
                 continue
-            counts[cls] += 1
-            total[cls] += 1
-        per_file[f.name] = dict(counts)
-    return per_file, dict(total)
+            kept.append(pos)
+        offsets, ids = kept, np.asarray(parsed, dtype=np.int64)
+    if (ids < 0).any():
+        # np.bincount 只接受非负 id
+        if offsets is None:
+            offsets = [m.start() for m in CLASS_TOKEN_RE.finditer(data)]
+        for pos in np.asarray(offsets)[ids < 0].tolist():
+            print(f"warning: negative class id in {label_path}:{_line_no(data, pos)}; skipping", file=sys.stderr)
+        ids = ids[ids >= 0]
+    return ids
+
+
+def _count_one_file(f: Path, minlength: int = 0) -> Tuple[str, np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """返回 (文件名, 稠密计数数组, (稀疏 id, 稀疏计数))。
+
+    np.bincount 会分配 max(id)+1 个槽位，因此只对小于 max(minlength, BINCOUNT_LIMIT) 的 id 用 bincount；
+    更大的离群 id 用 np.unique 稀疏计数，避免单行异常 id 占满内存。
+    """
+    with _map_label_file(f) as data:
+        ids = parse_class_ids(f, data)
+    limit = max(minlength, BINCOUNT_LIMIT)
+    rare = ids >= limit
+    if rare.any():
+        rare_ids, rare_counts = np.unique(ids[rare], return_counts=True)
+        ids = ids[~rare]
+    else:
+        rare_ids = rare_counts = np.zeros(0, dtype=np.int64)
+    return f.name, np.bincount(ids, minlength=minlength), (rare_ids, rare_counts)
+
+
+def _count_one_file_safe(f: Path, minlength: int = 0) -> Tuple[str, np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    try:
+        return _count_one_file(f, minlength)
+    except Exception as e:
+        print(f"error processing {f}: {e}", file=sys.stderr)
+        empty = np.zeros(0, dtype=np.int64)
+        return f.name, np.zeros(minlength, dtype=np.int64), (empty, empty)
+
+
+def stream_process(files: Iterable[Path], classes_map: Dict[int, str], executor: Optional[Executor] = None) -> Iterator[Tuple[str, np.ndarray, Tuple[np.ndarray, np.ndarray]]]:
+    """按文件名顺序逐个产出 _count_one_file 的结果，不在内存中保留全部文件的结果。
+
+    `executor` 为 None 时在当前进程串行处理。
+    """
+    files = sorted(files, key=lambda f: f.name)
+    # 按已知类别数预分配，各文件的计数数组长度一致，汇总时只需一次向量加法
+    num_classes = max(classes_map, default=-1) + 1
+    worker = functools.partial(_count_one_file_safe, minlength=num_classes)
+    if executor is None:
+        return map(worker, _read_ahead(files))
+    # 进程池的 map 会一次取完全部输入，预读窗口在这里不起作用，多个进程本身已让 IO 与解析重叠
+    return executor.map(worker, files, chunksize=64)
 
 
 def _next_index_for_prefix(out_dir: Path, prefix: str) -> int:
@@ -94,35 +246,76 @@ def _next_index_for_prefix(out_dir: Path, prefix: str) -> int:
     return max_idx + 1
 
 
-def save_results(per_file: dict, total: dict, out_dir: Path, classes_map: Dict[int, str]):
+def _write_csv(path: Path, header: list, records: Iterable[tuple]):
+    records = iter(records)
+    with path.open("w", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE) as fh:
+        writer = csv.writer(fh)
+        writer.writerow(header)
+        while True:
+            batch = list(itertools.islice(records, CSV_BATCH_ROWS))
+            if not batch:
+                break
+            writer.writerows(batch)
+
+
+def save_results(per_file: Iterable[Tuple[str, np.ndarray, Tuple[np.ndarray, np.ndarray]]], out_dir: Path, classes_map: Dict[int, str]):
+    """逐条写出 `per_file`（可以是 stream_process 的结果）中每个文件的计数，同时累加，最后写出总数。"""
     out_dir = out_dir or Path("count-result")
     out_dir.mkdir(parents=True, exist_ok=True)
     idx = _next_index_for_prefix(out_dir, "counts_per_image")
+    total = np.zeros(max(classes_map, default=-1) + 1, dtype=np.int64)
+    # 超出 bincount 上限的离群 id 很少见，用 dict 稀疏累加
+    rare_total: Dict[int, int] = {}
+
+    def _per_image_rows() -> Iterator[tuple]:
+        # 直接由 bincount 数组的非零项生成行，不经过中间 dict
+        nonlocal total
+        for image, counts, (rare_ids, rare_counts) in per_file:
+            if len(counts) > len(total):
+                # 出现 classes.txt 之外的类别 id 时才扩容
+                total = np.pad(total, (0, len(counts) - len(total)))
+            total[:len(counts)] += counts
+            # flatnonzero 的下标本身升序；离群 id 都大于 bincount 的范围且 np.unique 已排序，接在后面即可
+            nz = np.flatnonzero(counts)
+            ids = nz.tolist() + rare_ids.tolist()
+            values = counts[nz].tolist() + rare_counts.tolist()
+            for cls, c in zip(rare_ids.tolist(), rare_counts.tolist()):
+                rare_total[cls] = rare_total.get(cls, 0) + c
+            names = [classes_map.get(c, "") for c in ids]
+            yield from zip(itertools.repeat(image), ids, names, values)
+
     per_file_csv = out_dir / f"counts_per_image_{idx:03d}.csv"
-    with per_file_csv.open("w", newline="", encoding="utf-8") as fh:
-        writer = csv.writer(fh)
-        writer.writerow(["image", "class_id", "class_name", "count"])
-        for image, counts in sorted(per_file.items()):
-            for cls, c in sorted(counts.items()):
-                name = classes_map.get(cls, "")
-                writer.writerow([image, cls, name, c])
+    _write_csv(per_file_csv, ["image", "class_id", "class_name", "count"], _per_image_rows())
 
+    nz = np.flatnonzero(total)
+    ids = nz.tolist()
+    values = total[nz].tolist()
+    # 离群 id 一定不小于 len(total)（每个文件的 bincount 都覆盖了比它们小的 id），排序后接在后面
+    for cls, c in sorted(rare_total.items()):
+        ids.append(cls)
+        values.append(c)
     total_csv = out_dir / f"counts_total_{idx:03d}.csv"
-    with total_csv.open("w", newline="", encoding="utf-8") as fh:
-        writer = csv.writer(fh)
-        writer.writerow(["class_id", "class_name", "total_count"])
-        for cls, c in sorted(total.items()):
-            name = classes_map.get(cls, "")
-            writer.writerow([cls, name, c])
+    _write_csv(total_csv, ["class_id", "class_name", "total_count"], zip(ids, [classes_map.get(c, "") for c in ids], values))
 
     print(f"wrote: {per_file_csv}\nwrote: {total_csv}")
 
 
+def _positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"需要正整数，得到 {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"需要正整数，得到 {value!r}")
+    return n
+
+
 def main():
     p = argparse.ArgumentParser(description="统计 YOLOhbb 标注类别数量")
     p.add_argument("input", type=Path, help="标签文件或包含标签文件的文件夹")
     p.add_argument("--out", type=Path, default=Path("count-result"), help="输出目录, 默认 count-result")
     p.add_argument("--classes", type=Path, default=None, help="可选：classes.txt 文件路径（每行一个类别名，行号即 class id）")
+    p.add_argument("--workers", type=_positive_int, default=None, help="并行进程数，默认使用全部 CPU；1 表示不并行")
     args = p.parse_args()
 
     # try to locate classes.txt if not provided
@@ -146,8 +339,9 @@ def main():
     if not files:
         print("没有找到任何 .txt 标签文件", file=sys.stderr)
         raise SystemExit(2)
-    per_file, total = process_files(files, classes_map)
-    save_results(per_file, total, args.out, classes_map)
+    # 先建好进程池再打开输出文件
+    with (contextlib.nullcontext() if args.workers == 1 else ProcessPoolExecutor(max_workers=args.workers)) as ex:
+        save_results(stream_process(files, classes_map, ex), args.out, classes_map)
 
 
 if __name__ == "__main__":